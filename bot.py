@@ -1,16 +1,24 @@
 import os
-import json
+import orjson
+import asyncio
+import atexit
+import mmap
+import signal
+import sys
 import discord
 from discord.ext import commands
 from dotenv import load_dotenv
 import subprocess
 import time
 import logging
+import re
 import google.generativeai as genai
-import glob # Import glob for file listing
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
@@ -23,21 +31,47 @@ BOT_KEYWORDS_STR = os.getenv("BOT_KEYWORDS", "ai,bot,assistant")
 GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-pro") # Default to gemini-pro
 DEFAULT_SYSTEM_PROMPT = os.getenv("SYSTEM_PROMPT", "You are a helpful AI assistant.")
 CONTEXT_DIR = os.getenv("CONTEXT_DIR", "context") # New: Directory for context files
+CONTEXT_MAX_BYTES = 64 * 1024 # Context files larger than this are skipped
 
 # New environment variables for Rate Limiting
 RATE_LIMIT_MAX_PROMPTS = int(os.getenv("RATE_LIMIT_MAX_PROMPTS", 3)) # Default to 3 prompts
 RATE_LIMIT_SECONDS = int(os.getenv("RATE_LIMIT_SECONDS", 8))     # Default to 8 seconds
 
-# Parse BOT_KEYWORDS_STR into a list. This will be finalized in on_ready.
-KEYWORDS = [keyword.strip().lower() for keyword in BOT_KEYWORDS_STR.split(',')]
+# Help text only depends on the settings above, so it is built once instead of on every help command
+_HELP_MESSAGE = f"""
+**Available commands (prefix: `{COMMAND_PREFIX}`):**
+- `{COMMAND_PREFIX}help`: Shows this message.
+- `{COMMAND_PREFIX}setchannel`: Sets the current channel for continuous conversation.
+- `{COMMAND_PREFIX}unsetchannel`: Unsets the current channel from continuous conversation.
+- `{COMMAND_PREFIX}ignore`: Disables keyword-triggered replies in this channel.
+- `{COMMAND_PREFIX}unignore`: Enables keyword-triggered replies in this channel.
+- `{COMMAND_PREFIX}setcontext <context_name>`: Sets a specific AI context (persona/topic) for this channel. Contexts are loaded from the `{CONTEXT_DIR}` directory.
+- `{COMMAND_PREFIX}unsetcontext`: Removes the custom AI context for this channel, reverting to the default.
+- `{COMMAND_PREFIX}reloadcontexts`: Reloads the context files from the `{CONTEXT_DIR}` directory without restarting the bot.
+- `{COMMAND_PREFIX}time`: Shows the system uptime.
+
+*Note: If a channel is set for continuous conversation, I will respond to every message.
+If not, I will only respond if you mention a keyword (like 'ai', 'bot', 'assistant', or my name)
+and the channel is not ignored for keywords.*
+"""
+
+def parse_keywords(keywords_str, bot_name=None):
+    """Parses the comma-separated keyword setting into a lowercase, de-duplicated tuple, keeping the original order."""
+    keywords = [keyword.strip().lower() for keyword in keywords_str.split(',') if keyword.strip()]
+    if bot_name:
+        keywords.append(bot_name.lower())
+    return tuple(dict.fromkeys(keywords))
+
+# Parse BOT_KEYWORDS_STR into a tuple. This will be finalized in on_ready once the bot's name is known.
+KEYWORDS = parse_keywords(BOT_KEYWORDS_STR)
 
 # Initialize Discord Bot with intents
 intents = discord.Intents.default()
 intents.message_content = True # Required to read message content
-intents.members = True # Required for on_member_join, etc., if you add those features
+# The members intent is left off: nothing uses member events, and it makes Discord stream every guild's member list
 intents.guilds = True # Required for guild-related events
 
-bot = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents, help_command=None)
+bot = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents, help_command=None, chunk_guilds_at_startup=False)
 
 
 # --- Gemini API Configuration ---
@@ -45,179 +79,500 @@ model = None # Initialize model to None
 if GEMINI_API_KEY:
     try:
         genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel(GEMINI_MODEL_NAME) # Use the loaded model name
-        logging.info(f"Gemini API configured with model: {GEMINI_MODEL_NAME}")
+        model = genai.GenerativeModel(GEMINI_MODEL_NAME) # Use the loaded model name; variants with a system instruction are created by _get_model
+        log.info("Gemini API configured with model: %s", GEMINI_MODEL_NAME)
     except Exception as e:
-        logging.error(f"Failed to configure Gemini API or model: {e}")
+        log.error("Failed to configure Gemini API or model: %s", e)
         # model will remain None, get_gemini_response will handle this
 else:
-    logging.warning("GEMINI_API_KEY not found in .env. Gemini features will be disabled.")
+    log.warning("GEMINI_API_KEY not found in .env. Gemini features will be disabled.")
     # model will remain None
 
 # Data persistence setup
-DATA_FILE = "bot_data.json"
-bot_data = {} # This will hold the loaded data
-user_prompt_timestamps = {} # Transient state for rate limiting, renamed from keyword_trigger_timestamps
+DATA_DIR = "data" # <server_id>.json per server, <server_id>/<user_id>.json per user
+DATA_FILE = "bot_data.json" # Legacy single-file storage, migrated into DATA_DIR on first start
+MMAP_MIN_BYTES = 256 * 1024 # Data files at least this large are memory-mapped when loading
+SAVE_DEBOUNCE_SECONDS = 5 # Coalesce bursts of changes into at most one write per window
+USER_HISTORY_MAXLEN = 100 # Keep last 100 entries (50 user/bot pairs) of keyword history per user
+MAIN_HISTORY_MAXLEN = 200 # Keep last 200 entries (100 user/bot pairs) of set-channel history per server
+bot_data = {} # This will hold the loaded data: {server_id: ServerData}
+_dirty = asyncio.Event() # Set whenever bot_data changes; cleared by the background saver
+_dirty_servers = set() # IDs of servers whose settings or set-channel history changed since the last save
+_dirty_users = set() # (server_id, user_id) pairs whose data changed since the last save
+_save_lock = asyncio.Lock() # Serializes background writes
+_save_task = None # Background saver task, started in on_ready
+_legacy_file_pending = False # True while data loaded from DATA_FILE hasn't been completely saved into DATA_DIR yet
+user_rate_buckets = {} # Transient rate limiting state: {server_id: {user_id: [tokens, last_refill]}}
+RATE_LIMIT_SWEEP_SECONDS = 60 # How often buckets of idle users are dropped from user_rate_buckets
+_sweep_task = None # Rate limit sweeper task, started in on_ready
 loaded_contexts = {} # New: Stores loaded system prompts from context files
+_context_file_cache = {} # {path: (mtime_ns, content)} so reloads only re-read changed context files
+_NO_CHANNELS = frozenset() # Stand-in for the channel sets of servers that have no data yet
+_channel_system_prompts = {} # {(server_id, channel_id): resolved system prompt}, cleared when contexts change
+MODEL_CACHE_SIZE = 64 # Max number of Gemini models (one per distinct system prompt) kept around
+_models_by_prompt = OrderedDict() # LRU of {final_system_prompt: GenerativeModel}
+UPTIME_CACHE_SECONDS = 1 # How long a fetched uptime string is reused by the time command
+_uptime_cache = (0.0, "") # (monotonic time fetched, uptime text)
+
+# --- Data structures ---
+# History turns are stored as compact (role, text) tuples; role is ROLE_USER or ROLE_MODEL.
+ROLE_USER = "u"
+ROLE_MODEL = "m"
+_GEMINI_ROLES = {ROLE_USER: "user", ROLE_MODEL: "model"}
+
+def _turn_from_json(entry):
+    """Converts a stored history entry to a (role, text) tuple, accepting the older Gemini-style dict format too."""
+    if isinstance(entry, dict): # Legacy: {"role": "user/model", "parts": [{"text": "..."}]}
+        role = ROLE_MODEL if entry.get("role") == "model" else ROLE_USER
+        text = "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in entry.get("parts", ()))
+        return (role, text)
+    return (entry[0], entry[1])
+
+def _history_from_json(entries, maxlen):
+    """Builds a bounded history deque from its on-disk list form."""
+    return deque((_turn_from_json(entry) for entry in entries), maxlen=maxlen)
+
+def _record_turn(history, user_text, model_text):
+    """Appends one user/model exchange to a history deque; its maxlen drops the oldest turns."""
+    history.extend(((ROLE_USER, user_text), (ROLE_MODEL, model_text)))
+
+@dataclass(slots=True)
+class UserData:
+    """Per-user state within a server, used for keyword-triggered replies."""
+    rolling_history: deque = field(default_factory=lambda: deque(maxlen=USER_HISTORY_MAXLEN))
+    profile_summary: str = ""
+
+    def to_json(self):
+        """Returns the JSON-serializable form stored on disk."""
+        return {"rolling_history": list(self.rolling_history), "profile_summary": self.profile_summary}
+
+    @classmethod
+    def from_json(cls, data):
+        """Builds a UserData from its on-disk form, filling in any missing keys."""
+        return cls(
+            rolling_history=_history_from_json(data.get("rolling_history", ()), USER_HISTORY_MAXLEN),
+            profile_summary=data.get("profile_summary", ""),
+        )
+
+@dataclass(slots=True)
+class ServerData:
+    """Per-server state: channel settings, the shared set-channel history and per-user data."""
+    set_channels: set = field(default_factory=set) # Channel IDs (int) with continuous conversation
+    ignored_channels: set = field(default_factory=set) # Channel IDs (int) where keyword replies are off
+    main_chat_history: deque = field(default_factory=lambda: deque(maxlen=MAIN_HISTORY_MAXLEN))
+    users: dict = field(default_factory=dict) # {user_id: UserData}
+    channel_contexts: dict = field(default_factory=dict) # {channel_id (str): context name}
+
+    def to_json(self):
+        """
+        Returns the JSON-serializable form stored on disk (key names kept from the original dict layout).
+        Users are not included; each one is saved to its own file (see _user_data_path).
+        """
+        return {
+            "set_channels": sorted(self.set_channels),
+            "main_chat_history": list(self.main_chat_history),
+            "ignored_channels_for_keywords": sorted(self.ignored_channels),
+            "channel_active_contexts": self.channel_contexts,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        """Builds a ServerData from its on-disk form, filling in any missing keys. Users embedded by older versions are kept."""
+        return cls(
+            set_channels=set(data.get("set_channels", ())),
+            ignored_channels=set(data.get("ignored_channels_for_keywords", ())),
+            main_chat_history=_history_from_json(data.get("main_chat_history", ()), MAIN_HISTORY_MAXLEN),
+            users={user_id: UserData.from_json(user) for user_id, user in data.get("user_specific_context", {}).items()},
+            channel_contexts=data.get("channel_active_contexts", {}),
+        )
 
 # --- Helper functions for data persistence ---
-def load_data():
-    """Loads bot data from the JSON file."""
+def _server_data_path(server_id_str):
+    """Returns the path of the JSON file holding a server's settings and set-channel history."""
+    return os.path.join(DATA_DIR, f"{server_id_str}.json")
+
+def _user_data_path(server_id_str, user_id_str):
+    """Returns the path of the JSON file holding one user's data within a server."""
+    return os.path.join(DATA_DIR, server_id_str, f"{user_id_str}.json")
+
+def _read_json_file(path):
+    """
+    Reads and parses one JSON file. Returns None if it is missing or corrupted.
+    Large files are memory-mapped so orjson parses the mapped pages directly instead of a copy read into memory.
+    """
     try:
-        with open(DATA_FILE, "r") as f:
-            data = json.load(f)
-            logging.info(f"Loaded data from {DATA_FILE}")
-            return data
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < MMAP_MIN_BYTES: # For small files a plain read is cheaper than setting up a mapping
+                return orjson.loads(f.read())
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                return orjson.loads(view)
     except FileNotFoundError:
-        logging.warning(f"{DATA_FILE} not found. Initializing with empty data.")
-        return {} # Return an empty dict if file not found
-    except json.JSONDecodeError:
-        logging.error(f"Error decoding JSON from {DATA_FILE}. File might be corrupted. Initializing with empty data.")
-        return {} # Return an empty dict if JSON is invalid
-
-def save_data(data):
-    """Saves bot data to the JSON file."""
+        return None
+    except orjson.JSONDecodeError:
+        log.error("Error decoding JSON from %s. File might be corrupted. Skipping it.", path)
+        return None
+
+def _mark_all_dirty(data):
+    """Marks every server and user in data dirty, so the next save rewrites them in the current layout."""
+    for server_id_str, server in data.items():
+        mark_server_dirty(server_id_str)
+        for user_id_str in server.users:
+            mark_user_dirty(server_id_str, user_id_str)
+
+def _load_user_files(server_dir):
+    """Loads every <user_id>.json in a server's user directory. Returns {user_id: UserData}."""
+    users = {}
+    with os.scandir(server_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".json") and entry.is_file():
+                user_data = _read_json_file(entry.path)
+                if user_data is not None:
+                    users[entry.name[:-len(".json")]] = UserData.from_json(user_data)
+    return users
+
+def load_data():
+    """
+    Loads bot data from DATA_DIR: <server_id>.json per server plus <server_id>/<user_id>.json per user.
+    Server files from older versions that still embed their users, and the legacy single DATA_FILE, are migrated.
+    DATA_FILE stays the source of truth until one save pass has written all of it (see _retire_legacy_file).
+    """
+    global _legacy_file_pending
+    legacy_data = _read_json_file(DATA_FILE)
+    if legacy_data is not None:
+        log.info("Loaded legacy data from %s; it will be split into %s/ on the next save.", DATA_FILE, DATA_DIR)
+        data = {server_id_str: ServerData.from_json(server_data) for server_id_str, server_data in legacy_data.items()}
+        _mark_all_dirty(data)
+        _legacy_file_pending = True
+        _dirty.set() # Even an empty legacy file needs a save pass to retire it
+        return data
+
+    data = {}
+    if os.path.isdir(DATA_DIR):
+        user_dirs = {}
+        with os.scandir(DATA_DIR) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    user_dirs[entry.name] = entry.path
+                elif entry.name.endswith(".json") and entry.is_file():
+                    server_data = _read_json_file(entry.path)
+                    if server_data is not None:
+                        server_id_str = entry.name[:-len(".json")]
+                        server = data[server_id_str] = ServerData.from_json(server_data)
+                        if server.users: # Users still embedded in the server file: split them out on the next save
+                            _mark_all_dirty({server_id_str: server})
+        for server_id_str, server_dir in user_dirs.items():
+            server = data.setdefault(server_id_str, ServerData())
+            server.users.update(_load_user_files(server_dir)) # Per-user files are newer than any embedded copy
+        log.info("Loaded data for %s server(s) from %s/", len(data), DATA_DIR)
+        return data
+
+    log.warning("No data found in %s/ or %s. Initializing with empty data.", DATA_DIR, DATA_FILE)
+    return {}
+
+def _serialize_server(server_id_str):
+    """Returns a server's settings and set-channel history encoded as JSON bytes, or None if the server no longer exists."""
+    server_data = bot_data.get(server_id_str)
+    if server_data is None:
+        return None
+    return orjson.dumps(server_data.to_json()) # Compact output: fewer bytes to encode and write
+
+def _serialize_user(server_id_str, user_id_str):
+    """Returns one user's data encoded as JSON bytes, or None if the user no longer exists."""
+    server_data = bot_data.get(server_id_str)
+    user_data = server_data.users.get(user_id_str) if server_data is not None else None
+    if user_data is None:
+        return None
+    return orjson.dumps(user_data.to_json())
+
+def _write_blob(path, blob):
+    """
+    Writes blob to path via a temp file so a crash can't truncate it. Only touches the disk, so it can run in a worker thread.
+    Returns True if the file was written, False if the write failed.
+    """
+    tmp_file = f"{path}.tmp"
     try:
-        with open(DATA_FILE, "w") as f:
-            json.dump(data, f, indent=4)
-            logging.info(f"Saved data to {DATA_FILE}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_file, "wb") as f:
+            f.write(blob)
+        os.replace(tmp_file, path)
+        log.info("Saved data to %s", path)
+        return True
     except IOError as e:
-        logging.error(f"Error saving data to {DATA_FILE}: {e}")
+        log.error("Error saving data to %s: %s", path, e)
+        return False
+
+def mark_server_dirty(server_id_str):
+    """Schedules a server's settings and set-channel history to be written by the background saver."""
+    _dirty_servers.add(server_id_str)
+    _dirty.set()
+
+def mark_user_dirty(server_id_str, user_id_str):
+    """Schedules one user's data to be written by the background saver, without rewriting the rest of the server."""
+    _dirty_users.add((server_id_str, user_id_str))
+    _dirty.set()
+
+def _take_dirty():
+    """
+    Serializes every server and user marked dirty since the last save and resets the dirty state.
+    Returns a deque of (dirty_key, path, blob); serializing up front means the writes see a consistent snapshot.
+    dirty_key is the server ID or (server_id, user_id) pair, so entries that don't get written can be marked dirty again.
+    User files come first: a server file is written without its users, so when it replaces an older file that still
+    embeds them, their own files must already exist.
+    """
+    _dirty.clear()
+    pending = deque()
+    for dirty_key in _dirty_users:
+        blob = _serialize_user(*dirty_key)
+        if blob is not None:
+            pending.append((dirty_key, _user_data_path(*dirty_key), blob))
+    for server_id_str in _dirty_servers:
+        blob = _serialize_server(server_id_str)
+        if blob is not None:
+            pending.append((server_id_str, _server_data_path(server_id_str), blob))
+    _dirty_servers.clear()
+    _dirty_users.clear()
+    return pending
+
+def _write_entry(entry, failed_servers):
+    """
+    Writes one pending (dirty_key, path, blob) entry and returns whether it was written.
+    A server's file is held back while one of its user files failed in the same pass (failed_servers is updated here),
+    so a server file that still embeds users is never replaced before they are saved in their own files.
+    """
+    dirty_key, path, blob = entry
+    if isinstance(dirty_key, tuple):
+        if _write_blob(path, blob):
+            return True
+        failed_servers.add(dirty_key[0])
+        return False
+    return dirty_key not in failed_servers and _write_blob(path, blob)
+
+def _retire_legacy_file():
+    """Renames DATA_FILE out of the way once everything loaded from it has been saved into DATA_DIR."""
+    global _legacy_file_pending
+    try:
+        os.replace(DATA_FILE, f"{DATA_FILE}.migrated")
+        _legacy_file_pending = False
+        log.info("Migrated %s into %s/; renamed it to %s.migrated.", DATA_FILE, DATA_DIR, DATA_FILE)
+    except OSError as e:
+        log.error("Error renaming %s after migrating it: %s", DATA_FILE, e)
+
+def _requeue_dirty(entries):
+    """Marks the data behind unwritten pending entries dirty again, so the next save (or flush_data) retries them."""
+    for dirty_key, _, _ in entries:
+        if isinstance(dirty_key, tuple):
+            mark_user_dirty(*dirty_key)
+        else:
+            mark_server_dirty(dirty_key)
+
+async def _save_loop():
+    """Background task that persists changed data at most once per SAVE_DEBOUNCE_SECONDS after it is marked dirty."""
+    while True:
+        await _dirty.wait()
+        await asyncio.sleep(SAVE_DEBOUNCE_SECONDS) # Let further changes pile up before writing
+        async with _save_lock: # Only one writer at a time
+            pending = _take_dirty()
+            failed = []
+            failed_servers = set()
+            try:
+                while pending:
+                    if not await asyncio.to_thread(_write_entry, pending[0], failed_servers): # Keep disk I/O off the event loop
+                        failed.append(pending[0])
+                    pending.popleft() # Only dropped once its write has finished
+            finally:
+                # Failed writes and anything not reached (e.g. the task was cancelled at shutdown) stay dirty
+                _requeue_dirty(failed)
+                _requeue_dirty(pending)
+            if _legacy_file_pending and not failed: # Earlier failures were requeued into this pass, so nothing is missing
+                _retire_legacy_file()
+
+def flush_data():
+    """Writes any pending changes immediately. Registered to run at interpreter exit."""
+    if _dirty.is_set():
+        failed_servers = set()
+        written = [_write_entry(entry, failed_servers) for entry in _take_dirty()]
+        if _legacy_file_pending and all(written):
+            _retire_legacy_file()
+
+atexit.register(flush_data)
 
 # Load data at startup
 bot_data = load_data()
 
 # --- Helper functions for data structure management ---
 def ensure_server_data(server_id_str):
-    """Ensures the server's data structure exists in bot_data and has all necessary keys."""
-    modified = False
-    if server_id_str not in bot_data:
-        bot_data[server_id_str] = {
-            "set_channels": [],
-            "main_chat_history": [],
-            "ignored_channels_for_keywords": [],
-            "user_specific_context": {},
-            "channel_active_contexts": {}
-        }
-        logging.info(f"Initialized new data structure for server: {server_id_str}")
-        modified = True
-    else:
-        # Check and add missing keys for existing server entries
-        server_entry = bot_data[server_id_str]
-        keys_added = []
-        if "set_channels" not in server_entry:
-            server_entry["set_channels"] = []
-            keys_added.append("set_channels")
-        if "main_chat_history" not in server_entry:
-            server_entry["main_chat_history"] = []
-            keys_added.append("main_chat_history")
-        if "ignored_channels_for_keywords" not in server_entry:
-            server_entry["ignored_channels_for_keywords"] = []
-            keys_added.append("ignored_channels_for_keywords")
-        if "user_specific_context" not in server_entry:
-            server_entry["user_specific_context"] = {}
-            keys_added.append("user_specific_context")
-        if "channel_active_contexts" not in server_entry: # This is the key causing the error
-            server_entry["channel_active_contexts"] = {}
-            keys_added.append("channel_active_contexts")
-        
-        if keys_added:
-            logging.info(f"Added missing key(s) {', '.join(keys_added)} to server: {server_id_str}")
-            modified = True
-            
-    if modified:
-        save_data(bot_data)
+    """Ensures the server's data exists in bot_data and returns it."""
+    server = bot_data.get(server_id_str)
+    if server is None:
+        server = bot_data[server_id_str] = ServerData()
+        log.info("Initialized new data structure for server: %s", server_id_str)
+        mark_server_dirty(server_id_str)
+    return server
 
 def ensure_user_data(server_id_str, user_id_str):
-    """Ensures the user's data structure exists and has all necessary keys."""
-    ensure_server_data(server_id_str) # This will ensure bot_data[server_id_str]["user_specific_context"] exists
-
-    user_contexts = bot_data[server_id_str]["user_specific_context"]
-    modified = False
-
-    if user_id_str not in user_contexts:
-        user_contexts[user_id_str] = {
-            "rolling_history": [],
-            "profile_summary": ""
-        }
-        logging.info(f"Initialized new user context for user: {user_id_str} in server: {server_id_str}")
-        modified = True
-    else:
-        user_entry = user_contexts[user_id_str]
-        keys_added = []
-        if "rolling_history" not in user_entry:
-            user_entry["rolling_history"] = []
-            keys_added.append("rolling_history")
-        if "profile_summary" not in user_entry:
-            user_entry["profile_summary"] = ""
-            keys_added.append("profile_summary")
-        
-        if keys_added:
-            logging.info(f"Added missing key(s) {', '.join(keys_added)} for user: {user_id_str} in server: {server_id_str}")
-            modified = True
-            
-    if modified:
-        save_data(bot_data)
+    """Ensures the user's data exists within the server's data and returns it."""
+    users = ensure_server_data(server_id_str).users
+    user = users.get(user_id_str)
+    if user is None:
+        user = users[user_id_str] = UserData()
+        log.info("Initialized new user context for user: %s in server: %s", user_id_str, server_id_str)
+        mark_user_dirty(server_id_str, user_id_str)
+    return user
 
 # --- Context Loading Function ---
 def load_contexts():
-    """Loads system prompts from text files in the CONTEXT_DIR."""
+    """
+    Loads system prompts from text files in the CONTEXT_DIR.
+    Files are cached by modification time, so calling this again only re-reads files that were added or changed.
+    Returns the number of files that were (re)read.
+    """
     global loaded_contexts
-    loaded_contexts = {} # Clear existing contexts
-    if not os.path.exists(CONTEXT_DIR):
-        logging.warning(f"Context directory '{CONTEXT_DIR}' not found. No custom contexts will be loaded.")
-        return
+    loaded_contexts = {} # Rebuilt from the file cache below
+    _channel_system_prompts.clear() # Context contents may have changed
+    if not os.path.isdir(CONTEXT_DIR):
+        log.warning("Context directory '%s' not found. No custom contexts will be loaded.", CONTEXT_DIR)
+        _context_file_cache.clear()
+        return 0
+
+    files_read = 0
+    seen_paths = set()
+    with os.scandir(CONTEXT_DIR) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".txt") or not entry.is_file():
+                continue
+            seen_paths.add(entry.path)
+            context_name = os.path.splitext(entry.name)[0].lower() # Use filename without extension as context name
+            try:
+                stat = entry.stat()
+                if stat.st_size > CONTEXT_MAX_BYTES:
+                    log.warning("Skipping context file '%s': %s bytes exceeds the %s byte limit.", entry.name, stat.st_size, CONTEXT_MAX_BYTES)
+                    continue
+                mtime_ns = stat.st_mtime_ns
+                cached = _context_file_cache.get(entry.path)
+                if cached is None or cached[0] != mtime_ns:
+                    with open(entry.path, "r", encoding="utf-8") as f:
+                        cached = (mtime_ns, f.read().strip())
+                    _context_file_cache[entry.path] = cached
+                    files_read += 1
+                    log.info("Loaded context: '%s' from '%s'", context_name, entry.name)
+                loaded_contexts[context_name] = cached[1]
+            except Exception as e:
+                log.error("Error loading context file '%s': %s", entry.name, e)
+
+    # Forget files that have been deleted since the last load
+    for path in set(_context_file_cache) - seen_paths:
+        del _context_file_cache[path]
 
-    for filepath in glob.glob(os.path.join(CONTEXT_DIR, "*.txt")):
-        filename = os.path.basename(filepath)
-        context_name = os.path.splitext(filename)[0].lower() # Use filename without extension as context name
-        try:
-            with open(filepath, "r", encoding="utf-8") as f:
-                content = f.read().strip()
-                loaded_contexts[context_name] = content
-                logging.info(f"Loaded context: '{context_name}' from '{filename}'")
-        except Exception as e:
-            logging.error(f"Error loading context file '{filename}': {e}")
-    
     if not loaded_contexts:
-        logging.info(f"No context files found in '{CONTEXT_DIR}'.")
+        log.info("No context files found in '%s'.", CONTEXT_DIR)
     else:
-        logging.info(f"Available contexts: {', '.join(loaded_contexts.keys())}")
+        log.info("Available contexts: %s", ', '.join(loaded_contexts.keys()))
+    return files_read
+
+
+def get_channel_system_prompt(server_id_str, channel_id_str):
+    """Returns the system prompt for a channel: its active context if one is set, otherwise DEFAULT_SYSTEM_PROMPT."""
+    key = (server_id_str, channel_id_str)
+    system_prompt = _channel_system_prompts.get(key)
+    if system_prompt is None:
+        channel_context_name = ensure_server_data(server_id_str).channel_contexts.get(channel_id_str)
+        system_prompt = _channel_system_prompts[key] = loaded_contexts.get(channel_context_name, DEFAULT_SYSTEM_PROMPT)
+    return system_prompt
+
+# --- Keyword Matching ---
+def build_keyword_regex(keywords):
+    """
+    Compiles the keywords into one case-insensitive alternation that finds any of them as a whole word in a single scan.
+    Returns None if there are no keywords.
+    """
+    if not keywords:
+        return None
+    # Lookarounds instead of \b so keywords that start or end with punctuation still match as whole words
+    return re.compile(r"(?<!\w)(?:" + "|".join(map(re.escape, keywords)) + r")(?!\w)", re.IGNORECASE)
+
+_keyword_re = build_keyword_regex(KEYWORDS) # Rebuilt in on_ready once the bot's name is known
+_min_keyword_len = min(map(len, KEYWORDS), default=sys.maxsize) # Shorter messages can't contain a keyword
 
+def contains_keyword(text):
+    """Returns True if the text contains any of the KEYWORDS as a whole word, ignoring case."""
+    return _keyword_re is not None and _keyword_re.search(text) is not None
 
 # --- Centralized Rate Limiting Function ---
 def check_and_update_rate_limit(user_id: str, server_id: str) -> bool:
     """
-    Checks if a user is rate-limited for AI prompts and updates their timestamp.
+    Checks if a user is rate-limited for AI prompts using a token bucket and takes a token if not.
+    Each user's bucket holds up to RATE_LIMIT_MAX_PROMPTS tokens and refills completely over RATE_LIMIT_SECONDS.
     Returns True if the user is NOT rate-limited and the prompt can proceed, False otherwise.
+    A RATE_LIMIT_SECONDS of 0 (or less) disables rate limiting.
     """
-    current_time = time.time()
+    if RATE_LIMIT_SECONDS <= 0: # No window to count prompts in; also avoids dividing by zero below
+        return True
 
-    if server_id not in user_prompt_timestamps:
-        user_prompt_timestamps[server_id] = {}
-    if user_id not in user_prompt_timestamps[server_id]:
-        user_prompt_timestamps[server_id][user_id] = []
+    current_time = time.monotonic()
 
-    user_timestamps = user_prompt_timestamps[server_id][user_id]
-    # Filter out old timestamps
-    user_timestamps = [ts for ts in user_timestamps if current_time - ts < RATE_LIMIT_SECONDS]
+    server_buckets = user_rate_buckets.setdefault(server_id, {})
+    bucket = server_buckets.get(user_id)
+    if bucket is None:
+        bucket = server_buckets[user_id] = [float(RATE_LIMIT_MAX_PROMPTS), current_time] # [tokens, last_refill]
 
-    if len(user_timestamps) >= RATE_LIMIT_MAX_PROMPTS:
-        logging.info(f"User {user_id} in server {server_id} rate limited for AI prompts.")
+    # Refill proportionally to the time since the last prompt, capped at the bucket size
+    elapsed = current_time - bucket[1]
+    tokens = min(RATE_LIMIT_MAX_PROMPTS, bucket[0] + elapsed * RATE_LIMIT_MAX_PROMPTS / RATE_LIMIT_SECONDS)
+    bucket[1] = current_time
+
+    if tokens < 1:
+        bucket[0] = tokens
+        log.info("User %s in server %s rate limited for AI prompts.", user_id, server_id)
         return False # Rate limited
 
-    user_timestamps.append(current_time)
-    user_prompt_timestamps[server_id][user_id] = user_timestamps
+    bucket[0] = tokens - 1
     return True # Not rate limited, prompt can proceed
 
+def prune_rate_limits():
+    """
+    Drops the buckets of users idle for at least RATE_LIMIT_SECONDS (they have fully refilled, so a fresh bucket is
+    equivalent) and any servers left without buckets. Keeps user_rate_buckets proportional to recently active users.
+    """
+    cutoff = time.monotonic() - RATE_LIMIT_SECONDS
+    for server_id, server_buckets in list(user_rate_buckets.items()):
+        for user_id in [user_id for user_id, bucket in server_buckets.items() if bucket[1] <= cutoff]:
+            del server_buckets[user_id]
+        if not server_buckets:
+            del user_rate_buckets[server_id]
+
+async def _sweep_rate_limits():
+    """Background task that prunes idle rate limit buckets every RATE_LIMIT_SWEEP_SECONDS."""
+    while True:
+        await asyncio.sleep(RATE_LIMIT_SWEEP_SECONDS)
+        prune_rate_limits()
+
 # --- Gemini API Interaction ---
+def _get_model(final_system_prompt):
+    """Returns a Gemini model that carries final_system_prompt as its system instruction, creating it on first use."""
+    cached_model = _models_by_prompt.get(final_system_prompt)
+    if cached_model is not None:
+        _models_by_prompt.move_to_end(final_system_prompt)
+        return cached_model
+
+    prompt_model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=final_system_prompt or None)
+    _models_by_prompt[final_system_prompt] = prompt_model
+    if len(_models_by_prompt) > MODEL_CACHE_SIZE:
+        _models_by_prompt.popitem(last=False) # Evict the least recently used model
+    return prompt_model
+
+def _to_gemini_history(history):
+    """Yields stored (role, text) turns in the `{"role": "user/model", "parts": [{"text": "..."}]}` form Gemini expects."""
+    for role, text in history:
+        yield {"role": _GEMINI_ROLES[role], "parts": [{"text": text}]}
+
 async def get_gemini_response(prompt_history, current_message_content, system_prompt_base, profile_summary_text=""):
     """
     Interacts with the Gemini API.
     Combines system_prompt_base and profile_summary_text for the AI's context.
+    Each call is a single stateless generate_content request; prompt_history is the persisted history of (role, text) turns.
     """
     if not model: # Check if the global 'model' object was successfully initialized
-        logging.warning("Gemini model not available. Returning placeholder.")
+        log.warning("Gemini model not available. Returning placeholder.")
         return "My AI capabilities are currently disabled (model not loaded)."
 
     # Construct the final system prompt
@@ -225,62 +580,53 @@ async def get_gemini_response(prompt_history, current_message_content, system_pr
     if profile_summary_text:
         final_system_prompt += f"\n\nUser profile context: {profile_summary_text}"
     
-    logging.debug(f"Final system context for Gemini: '{final_system_prompt}'") # Changed to debug
-    logging.debug(f"Sending to Gemini - History: {prompt_history}, Current: {current_message_content}")
+    log.debug("Final system context for Gemini: '%s'", final_system_prompt) # Changed to debug
+    log.debug("Sending to Gemini - History: %s, Current: %s", prompt_history, current_message_content)
 
     try:
-        # For Gemini, the system instruction is often the first turn in the history,
-        # or set during model initialization for some models.
-        # For `start_chat`, we prepend it to the history if it's not already there.
-        # Gemini's `start_chat` expects history to be a list of `{"role": "user/model", "parts": [{"text": "..."}]}`
-        
-        # Create a temporary history including the system prompt as the first user turn
-        # This is a common way to pass system instructions to chat models if not directly supported
-        # by a dedicated parameter.
-        temp_history = []
-        if final_system_prompt:
-            temp_history.append({"role": "user", "parts": [{"text": final_system_prompt}]})
-            temp_history.append({"role": "model", "parts": [{"text": "Okay, I understand."}]}) # Bot acknowledges system prompt
-        
-        # Append the actual conversation history
-        temp_history.extend(prompt_history)
-
-        chat_session = model.start_chat(history=temp_history)
-        response = await chat_session.send_message_async(current_message_content)
+        # The system prompt is passed as the model's system instruction, so the contents are just the conversation.
+        contents = list(_to_gemini_history(prompt_history))
+        contents.append({"role": "user", "parts": [{"text": current_message_content}]})
+        response = await _get_model(final_system_prompt).generate_content_async(contents)
         
         if response and response.text:
-            logging.info("Received response from Gemini.")
+            log.info("Received response from Gemini.")
             return response.text
         else:
-            logging.warning("Gemini returned an empty or invalid response.")
+            log.warning("Gemini returned an empty or invalid response.")
             if response and response.prompt_feedback: # Check for safety feedback
-                logging.warning(f"Gemini prompt feedback: {response.prompt_feedback}")
+                log.warning("Gemini prompt feedback: %s", response.prompt_feedback)
                 if response.prompt_feedback.block_reason:
                      return f"My safety filters prevented a response: {response.prompt_feedback.block_reason_message or response.prompt_feedback.block_reason}"
             return "I received that, but I don't have a specific response right now."
     except Exception as e:
-        logging.error(f"Gemini API error: {e}")
+        log.error("Gemini API error: %s", e)
         return "Oops! I encountered an error trying to process that with my AI. Please try again later."
 
 # --- Bot Events ---
 @bot.event
 async def on_ready():
     """Logs when the bot is ready and connected to Discord."""
-    global KEYWORDS # Declare KEYWORDS as global to modify it
-    if bot.user and bot.user.name.lower() not in KEYWORDS:
-        KEYWORDS.append(bot.user.name.lower())
+    global KEYWORDS, _keyword_re, _min_keyword_len, _save_task, _sweep_task # Declare globals modified here
+    KEYWORDS = parse_keywords(BOT_KEYWORDS_STR, bot.user.name if bot.user else None) # Rebuilt from scratch so reconnects can't add duplicates
+    _keyword_re = build_keyword_regex(KEYWORDS)
+    _min_keyword_len = min(map(len, KEYWORDS), default=sys.maxsize)
     
     load_contexts() # New: Load contexts on startup
 
-    logging.info(f'{bot.user} has connected to Discord!')
-    logging.info(f'Command Prefix: {COMMAND_PREFIX}')
-    logging.info(f'Keywords: {KEYWORDS}') # Log the finalized keywords
-    logging.info(f'Gemini Model: {GEMINI_MODEL_NAME if model else "Not loaded/configured"}')
-    logging.info(f'Default System Prompt: "{DEFAULT_SYSTEM_PROMPT}"')
-    logging.info(f'AI Rate Limit: {RATE_LIMIT_MAX_PROMPTS} prompts per {RATE_LIMIT_SECONDS} seconds per user.')
-    logging.info(f'Context Directory: {CONTEXT_DIR}')
-    # Fix: Changed outer f-string quotes to double quotes to allow single quotes inside
-    logging.info(f"Available Contexts: {', '.join(loaded_contexts.keys()) if loaded_contexts else 'None'}")
+    if _save_task is None or _save_task.done(): # on_ready can fire again after reconnects
+        _save_task = bot.loop.create_task(_save_loop())
+    if _sweep_task is None or _sweep_task.done():
+        _sweep_task = bot.loop.create_task(_sweep_rate_limits())
+
+    log.info("%s has connected to Discord!", bot.user)
+    log.info("Command Prefix: %s", COMMAND_PREFIX)
+    log.info("Keywords: %s", KEYWORDS) # Log the finalized keywords
+    log.info("Gemini Model: %s", GEMINI_MODEL_NAME if model else "Not loaded/configured")
+    log.info('Default System Prompt: "%s"', DEFAULT_SYSTEM_PROMPT)
+    log.info("AI Rate Limit: %s prompts per %s seconds per user.", RATE_LIMIT_MAX_PROMPTS, RATE_LIMIT_SECONDS)
+    log.info("Context Directory: %s", CONTEXT_DIR)
+    log.info("Available Contexts: %s", ', '.join(loaded_contexts.keys()) if loaded_contexts else 'None')
     
     print(f'{bot.user} has connected to Discord!')
     print(f'Command Prefix: {COMMAND_PREFIX}')
@@ -298,92 +644,90 @@ async def on_message(message):
         await message.channel.send("I currently only operate in server channels, not DMs.")
         return
 
-    server_id = str(message.guild.id)
-    channel_id = str(message.channel.id) # Convert to string for dictionary keys
-    user_id = str(message.author.id)
-    message_content = message.content.lower()
-
-    # Ensure server and user data structures exist
-    ensure_server_data(server_id)
-    ensure_user_data(server_id, user_id)
-
     # --- Command Processing ---
     # Let the commands.Bot handle commands first.
     if message.content.startswith(COMMAND_PREFIX):
         await bot.process_commands(message)
         return # Command handled, stop further processing
 
-    # --- Determine the base system prompt for this interaction ---
-    # Check if a specific context is set for this channel
-    channel_context_name = bot_data[server_id]["channel_active_contexts"].get(channel_id)
-    system_prompt_base_for_gemini = loaded_contexts.get(channel_context_name, DEFAULT_SYSTEM_PROMPT)
+    # Look up (but don't create) this server's data; entries are only created once the bot actually replies
+    server_id = str(message.guild.id)
+    server = bot_data.get(server_id)
+    set_channels = server.set_channels if server is not None else _NO_CHANNELS
+    ignored_channels = server.ignored_channels if server is not None else _NO_CHANNELS
 
-    # --- Keyword Detection Logic ---
-    ignored_channels = bot_data[server_id]["ignored_channels_for_keywords"]
+    # Fast path: short messages (e.g. "ok", "lol") outside set channels can't trigger a reply
+    if len(message.content) < _min_keyword_len and message.channel.id not in set_channels:
+        return
 
-    is_keyword_triggered = any(keyword in message_content for keyword in KEYWORDS)
+    # --- Keyword Detection Logic ---
+    # Only scan the message once we know keywords are being listened for in this channel
+    is_keyword_triggered = (
+        message.channel.id not in ignored_channels
+        and contains_keyword(message.content)
+    )
+    if not is_keyword_triggered and message.channel.id not in set_channels:
+        return # Nothing to reply to; the common case for busy servers
+
+    channel_id = str(message.channel.id) # String form for dictionary keys; the channel sets use the int ID
+    user_id = str(message.author.id)
 
-    if is_keyword_triggered and int(channel_id) not in ignored_channels: # Convert channel_id back to int for 'ignored_channels' list
+    if is_keyword_triggered:
         # Apply Rate Limiting for Keyword Triggers
         if not check_and_update_rate_limit(user_id, server_id):
             await message.channel.send(f"{message.author.mention}, you're asking for AI responses a bit too quickly! Please wait a moment.")
             return # Do not process this keyword trigger
 
         # Process with Gemini for keyword trigger (user-specific context)
-        user_context = bot_data[server_id]["user_specific_context"][user_id]
-        rolling_history = user_context["rolling_history"]
-        profile_summary = user_context["profile_summary"]
+        user_context = ensure_user_data(server_id, user_id)
+        rolling_history = user_context.rolling_history
+        profile_summary = user_context.profile_summary
 
         # Construct prompt for Gemini
-        gemini_history = rolling_history # Assuming rolling_history is already in Gemini format
+        gemini_history = rolling_history # (role, text) turns, converted to Gemini's format for each request
         
+        # Uses the context set for this channel, if any (resolved once per channel and cached)
+        system_prompt_base_for_gemini = get_channel_system_prompt(server_id, channel_id)
+
         try:
             response_text = await get_gemini_response(gemini_history, message.content, system_prompt_base_for_gemini, profile_summary)
             await message.channel.send(response_text)
 
-            # Update rolling history (FIFO)
-            rolling_history.append({"role": "user", "parts": [{"text": message.content}]})
-            rolling_history.append({"role": "model", "parts": [{"text": response_text}]})
-            if len(rolling_history) > 100: # Keep last 100 entries (50 user/bot pairs)
-                rolling_history.pop(0)
-                rolling_history.pop(0)
+            _record_turn(rolling_history, message.content, response_text)
 
-            save_data(bot_data)
-            logging.info(f"Keyword triggered response sent in channel {channel_id} for user {user_id}.")
+            mark_user_dirty(server_id, user_id) # Only this user's history changed
+            log.info("Keyword triggered response sent in channel %s for user %s.", channel_id, user_id)
         except Exception as e:
-            logging.error(f"Error during keyword-triggered Gemini interaction: {e}")
+            log.error("Error during keyword-triggered Gemini interaction: %s", e)
             await message.channel.send("Sorry, I couldn't process that keyword request right now.")
         return # Keyword interaction handled, stop further processing
 
     # --- Set Channel Interaction Logic ---
-    set_channels = bot_data[server_id]["set_channels"]
-    if int(channel_id) in set_channels: # Convert channel_id back to int for 'set_channels' list
+    if message.channel.id in set_channels: # Only possible if the server's data already exists
         # Apply Rate Limiting for Set Channel Triggers
         if not check_and_update_rate_limit(user_id, server_id):
             await message.channel.send(f"{message.author.mention}, you're sending messages too quickly in this AI channel! Please wait a moment.")
             return # Do not process this set channel trigger
 
         # Process with Gemini for set channel (main chat history)
-        main_chat_history = bot_data[server_id]["main_chat_history"]
+        main_chat_history = server.main_chat_history
 
         # Construct prompt for Gemini
-        gemini_history = main_chat_history # Assuming main_chat_history is already in Gemini format
+        gemini_history = main_chat_history # (role, text) turns, converted to Gemini's format for each request
         
+        # Uses the context set for this channel, if any (resolved once per channel and cached)
+        system_prompt_base_for_gemini = get_channel_system_prompt(server_id, channel_id)
+
         try:
             response_text = await get_gemini_response(gemini_history, message.content, system_prompt_base_for_gemini, "") # No profile summary for set channels
             await message.channel.send(response_text)
 
-            # Update main chat history (FIFO)
-            main_chat_history.append({"role": "user", "parts": [{"text": message.content}]})
-            main_chat_history.append({"role": "model", "parts": [{"text": response_text}]})
-            if len(main_chat_history) > 200: # Keep last 200 entries (100 user/bot pairs)
-                main_chat_history.pop(0)
-                main_chat_history.pop(0)
+            _record_turn(main_chat_history, message.content, response_text)
 
-            save_data(bot_data)
-            logging.info(f"Set channel response sent in channel {channel_id}.")
+            mark_server_dirty(server_id)
+            log.info("Set channel response sent in channel %s.", channel_id)
         except Exception as e:
-            logging.error(f"Error during set-channel Gemini interaction: {e}")
+            log.error("Error during set-channel Gemini interaction: %s", e)
             await message.channel.send("Sorry, I couldn't continue our conversation right now.")
 
 # --- Bot Commands ---
@@ -393,13 +737,13 @@ async def set_channel_cmd(ctx):
     server_id = str(ctx.guild.id)
     channel_id = ctx.channel.id
 
-    ensure_server_data(server_id)
+    server = ensure_server_data(server_id)
 
-    if channel_id not in bot_data[server_id]["set_channels"]:
-        bot_data[server_id]["set_channels"].append(channel_id)
-        save_data(bot_data)
+    if channel_id not in server.set_channels:
+        server.set_channels.add(channel_id)
+        mark_server_dirty(server_id)
         await ctx.send(f"This channel ({ctx.channel.mention}) has been set for continuous conversation.")
-        logging.info(f"Channel {channel_id} set for continuous conversation in server {server_id}.")
+        log.info("Channel %s set for continuous conversation in server %s.", channel_id, server_id)
     else:
         await ctx.send(f"This channel ({ctx.channel.mention}) is already set for continuous conversation.")
 
@@ -409,13 +753,13 @@ async def unset_channel_cmd(ctx):
     server_id = str(ctx.guild.id)
     channel_id = ctx.channel.id
 
-    ensure_server_data(server_id)
+    server = ensure_server_data(server_id)
 
-    if channel_id in bot_data[server_id]["set_channels"]:
-        bot_data[server_id]["set_channels"].remove(channel_id)
-        save_data(bot_data)
+    if channel_id in server.set_channels:
+        server.set_channels.discard(channel_id)
+        mark_server_dirty(server_id)
         await ctx.send(f"This channel ({ctx.channel.mention}) has been unset from continuous conversation.")
-        logging.info(f"Channel {channel_id} unset from continuous conversation in server {server_id}.")
+        log.info("Channel %s unset from continuous conversation in server %s.", channel_id, server_id)
     else:
         await ctx.send(f"This channel ({ctx.channel.mention}) was not set for continuous conversation.")
 
@@ -425,13 +769,13 @@ async def ignore_cmd(ctx):
     server_id = str(ctx.guild.id)
     channel_id = ctx.channel.id
 
-    ensure_server_data(server_id)
+    server = ensure_server_data(server_id)
 
-    if channel_id not in bot_data[server_id]["ignored_channels_for_keywords"]:
-        bot_data[server_id]["ignored_channels_for_keywords"].append(channel_id)
-        save_data(bot_data)
+    if channel_id not in server.ignored_channels:
+        server.ignored_channels.add(channel_id)
+        mark_server_dirty(server_id)
         await ctx.send(f"Keyword replies are now ignored in this channel ({ctx.channel.mention}).")
-        logging.info(f"Channel {channel_id} set to ignore keyword replies in server {server_id}.")
+        log.info("Channel %s set to ignore keyword replies in server %s.", channel_id, server_id)
     else:
         await ctx.send(f"Keyword replies are already ignored in this channel ({ctx.channel.mention}).")
 
@@ -441,13 +785,13 @@ async def unignore_cmd(ctx):
     server_id = str(ctx.guild.id)
     channel_id = ctx.channel.id
 
-    ensure_server_data(server_id)
+    server = ensure_server_data(server_id)
 
-    if channel_id in bot_data[server_id]["ignored_channels_for_keywords"]:
-        bot_data[server_id]["ignored_channels_for_keywords"].remove(channel_id)
-        save_data(bot_data)
+    if channel_id in server.ignored_channels:
+        server.ignored_channels.discard(channel_id)
+        mark_server_dirty(server_id)
         await ctx.send(f"Keyword replies are now enabled in this channel ({ctx.channel.mention}).")
-        logging.info(f"Channel {channel_id} set to enable keyword replies in server {server_id}.")
+        log.info("Channel %s set to enable keyword replies in server %s.", channel_id, server_id)
     else:
         await ctx.send(f"Keyword replies were not ignored in this channel ({ctx.channel.mention}).")
 
@@ -458,17 +802,18 @@ async def set_context_cmd(ctx, context_name: str):
     channel_id = str(ctx.channel.id)
     context_name_lower = context_name.lower()
 
-    ensure_server_data(server_id)
+    server = ensure_server_data(server_id)
 
     if context_name_lower in loaded_contexts:
-        bot_data[server_id]["channel_active_contexts"][channel_id] = context_name_lower
-        save_data(bot_data)
+        server.channel_contexts[channel_id] = context_name_lower
+        _channel_system_prompts.pop((server_id, channel_id), None)
+        mark_server_dirty(server_id)
         await ctx.send(f"AI context for this channel ({ctx.channel.mention}) set to: `{context_name_lower}`.")
-        logging.info(f"Channel {channel_id} context set to '{context_name_lower}' in server {server_id}.")
+        log.info("Channel %s context set to '%s' in server %s.", channel_id, context_name_lower, server_id)
     else:
         available_contexts = ", ".join(loaded_contexts.keys()) if loaded_contexts else "None"
         await ctx.send(f"Context `{context_name}` not found. Available contexts: {available_contexts}")
-        logging.warning(f"Attempted to set unknown context '{context_name}' for channel {channel_id}.")
+        log.warning("Attempted to set unknown context '%s' for channel %s.", context_name, channel_id)
 
 @bot.command(name="unsetcontext", help=f"Removes the custom AI context for this channel. Use: {COMMAND_PREFIX}unsetcontext")
 async def unset_context_cmd(ctx):
@@ -476,66 +821,109 @@ async def unset_context_cmd(ctx):
     server_id = str(ctx.guild.id)
     channel_id = str(ctx.channel.id)
 
-    ensure_server_data(server_id)
+    server = ensure_server_data(server_id)
 
-    if channel_id in bot_data[server_id]["channel_active_contexts"]:
-        del bot_data[server_id]["channel_active_contexts"][channel_id]
-        save_data(bot_data)
+    if channel_id in server.channel_contexts:
+        del server.channel_contexts[channel_id]
+        _channel_system_prompts.pop((server_id, channel_id), None)
+        mark_server_dirty(server_id)
         await ctx.send(f"Custom AI context for this channel ({ctx.channel.mention}) has been removed. Reverting to default.")
-        logging.info(f"Channel {channel_id} context unset in server {server_id}.")
+        log.info("Channel %s context unset in server %s.", channel_id, server_id)
     else:
         await ctx.send(f"This channel ({ctx.channel.mention}) does not have a custom AI context set.")
 
+@bot.command(name="reloadcontexts", help=f"Reloads the AI context files from disk. Use: {COMMAND_PREFIX}reloadcontexts")
+async def reload_contexts_cmd(ctx):
+    """Reloads context files from CONTEXT_DIR, re-reading only the ones that changed."""
+    files_read = load_contexts()
+    available_contexts = ", ".join(loaded_contexts.keys()) if loaded_contexts else "None"
+    await ctx.send(f"Reloaded contexts ({files_read} file(s) updated). Available contexts: {available_contexts}")
+    log.info("Contexts reloaded by %s; %s file(s) re-read.", ctx.author.name, files_read)
+
+def format_uptime(seconds):
+    """Formats a number of seconds the way 'uptime -p' does, e.g. 'up 1 week, 2 days, 3 hours, 4 minutes'."""
+    minutes = int(seconds) // 60
+    parts = []
+    for unit, size in (("year", 525600), ("week", 10080), ("day", 1440), ("hour", 60), ("minute", 1)):
+        count, minutes = divmod(minutes, size)
+        if count:
+            parts.append(f"{count} {unit}{'s' if count != 1 else ''}")
+    return "up " + (", ".join(parts) if parts else "0 minutes")
+
+async def get_uptime():
+    """
+    Returns the system uptime formatted like 'uptime -p'.
+    Reads /proc/uptime directly where available; otherwise runs 'uptime -p' without blocking the event loop.
+    The result is cached for UPTIME_CACHE_SECONDS so bursts of $time share one lookup.
+    Raises FileNotFoundError / subprocess.CalledProcessError like subprocess.run(check=True).
+    """
+    global _uptime_cache
+    cached_at, cached_text = _uptime_cache
+    if cached_text and time.monotonic() - cached_at < UPTIME_CACHE_SECONDS:
+        return cached_text
+
+    try:
+        with open('/proc/uptime') as f: # A tiny in-memory procfs read, no process spawn
+            uptime_info = format_uptime(float(f.read().split()[0]))
+        _uptime_cache = (time.monotonic(), uptime_info)
+        return uptime_info
+    except (OSError, ValueError, IndexError):
+        pass # Not Linux (or an unusual procfs); fall back to the uptime command
+
+    proc = await asyncio.create_subprocess_exec(
+        'uptime', '-p', stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, ['uptime', '-p'], output=stdout.decode(), stderr=stderr.decode())
+
+    uptime_info = stdout.decode().strip()
+    _uptime_cache = (time.monotonic(), uptime_info)
+    return uptime_info
+
 @bot.command(name="time", help=f"Shows the system uptime. Use: {COMMAND_PREFIX}time")
 async def time_cmd(ctx):
-    """Shows the system uptime using the 'uptime' command."""
+    """Shows the system uptime (from /proc/uptime, or the 'uptime' command where that isn't available)."""
     try:
-        result = subprocess.run(['uptime', '-p'], capture_output=True, text=True, check=True)
-        uptime_info = result.stdout.strip()
+        uptime_info = await get_uptime()
         await ctx.send(f"System uptime: {uptime_info}")
-        logging.info(f"Uptime command executed for {ctx.author.name}.")
+        log.info("Uptime command executed for %s.", ctx.author.name)
     except FileNotFoundError:
         await ctx.send("Error: `uptime` command not found on the system.")
-        logging.error("`uptime` command not found on the system.")
+        log.error("`uptime` command not found on the system.")
     except subprocess.CalledProcessError as e:
         await ctx.send(f"Error executing uptime command: {e.stderr.strip()}")
-        logging.error(f"Error executing uptime command: {e.stderr.strip()}")
+        log.error("Error executing uptime command: %s", e.stderr.strip())
     except Exception as e:
         await ctx.send(f"An unexpected error occurred: {e}")
-        logging.error(f"An unexpected error occurred during uptime command: {e}")
+        log.error("An unexpected error occurred during uptime command: %s", e)
 
 @bot.command(name="help", help=f"Shows this help message. Use: {COMMAND_PREFIX}help")
 async def help_cmd(ctx):
     """Lists available commands and their basic usage."""
-    help_message = f"""
-**Available commands (prefix: `{COMMAND_PREFIX}`):**
-- `{COMMAND_PREFIX}help`: Shows this message.
-- `{COMMAND_PREFIX}setchannel`: Sets the current channel for continuous conversation.
-- `{COMMAND_PREFIX}unsetchannel`: Unsets the current channel from continuous conversation.
-- `{COMMAND_PREFIX}ignore`: Disables keyword-triggered replies in this channel.
-- `{COMMAND_PREFIX}unignore`: Enables keyword-triggered replies in this channel.
-- `{COMMAND_PREFIX}setcontext <context_name>`: Sets a specific AI context (persona/topic) for this channel. Contexts are loaded from the `{CONTEXT_DIR}` directory.
-- `{COMMAND_PREFIX}unsetcontext`: Removes the custom AI context for this channel, reverting to the default.
-- `{COMMAND_PREFIX}time`: Shows the system uptime.
-
-*Note: If a channel is set for continuous conversation, I will respond to every message.
-If not, I will only respond if you mention a keyword (like 'ai', 'bot', 'assistant', or my name)
-and the channel is not ignored for keywords.*
-"""
-    await ctx.send(help_message)
-    logging.info(f"Help message sent to {ctx.author.name} in channel {ctx.channel.id}.")
+    await ctx.send(_HELP_MESSAGE)
+    log.info("Help message sent to %s in channel %s.", ctx.author.name, ctx.channel.id)
 
 # --- Run the bot ---
 if __name__ == "__main__":
     if not DISCORD_TOKEN:
-        logging.critical("DISCORD_TOKEN not found in .env. Please set it to run the bot.")
+        log.critical("DISCORD_TOKEN not found in .env. Please set it to run the bot.")
         print("Error: DISCORD_TOKEN not found in .env. Please set it to run the bot.")
     else:
+        # Turn SIGTERM into a normal exit so the atexit flush still runs
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        # Use uvloop's faster event loop when it's installed (Linux/macOS); otherwise keep asyncio's default
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            log.info("Using uvloop event loop.")
+        except ImportError:
+            pass
         try:
             bot.run(DISCORD_TOKEN)
         except discord.LoginFailure:
-            logging.critical("Invalid Discord token. Please check your DISCORD_TOKEN in .env.")
+            log.critical("Invalid Discord token. Please check your DISCORD_TOKEN in .env.")
             print("Error: Invalid Discord token. Please check your DISCORD_TOKEN in .env.")
         except Exception as e:
-            logging.critical(f"An unexpected error occurred while running the bot: {e}")
+            log.critical("An unexpected error occurred while running the bot: %s", e)
             print(f"An unexpected error occurred while running the bot: {e}")